@@ -0,0 +1,28 @@
+# config_loader.py 讀取 /data/config.yaml (僅在未由 main.py 直接傳入設定時使用)
+import os
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Mapping
+
+CONFIG_PATH = "/data/config.yaml"
+
+@lru_cache(maxsize=8)
+def _load_yaml(path: str, mtime_ns: int, size: int) -> Mapping[str, Any]:
+    """實際解析 YAML；以 (路徑, 修改時間, 檔案大小) 為快取鍵，檔案未變動時不重複解析"""
+    import yaml
+
+    # 🟢 [優化] 有 libyaml 時使用 C 解析器，否則退回純 Python SafeLoader
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path, "r", encoding="utf-8") as f:
+        # 快取內容為共用物件，以唯讀 mapping 回傳避免被呼叫端修改
+        return MappingProxyType(yaml.load(f, Loader=loader) or {})
+
+def load_config(path: str = CONFIG_PATH) -> Mapping[str, Any]:
+    """讀取 YAML 設定檔；PyYAML 延遲到真正需要讀檔時才載入"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"找不到設定檔: {path}") from None
+
+    # 同一秒內改寫的檔案 mtime 可能不變，加上檔案大小一併比對
+    return _load_yaml(path, st.st_mtime_ns, st.st_size)
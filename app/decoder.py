@@ -1,57 +1,84 @@
 import struct
 import logging
-from typing import Dict, Any, Optional
-from bms_registers import BMS_MAP
+from typing import Dict, Any, Optional, Callable, Tuple
+from bms_registers import BMS_MAP, conv_none
 
 logger = logging.getLogger("jk_bms_decoder")
 
-def extract_device_address(packet: bytes) -> Optional[int]:
-    try:
-        # 策略 1: 優先檢查 270 (與 BMS_MAP 對齊)
-        if len(packet) >= 274:
-            val_270 = struct.unpack_from("<I", packet, 270)[0]
-            # 🟢 [優化] 防禦 RS485 雜訊：限制 ID 在 0~15 的合理範圍
-            if 0 <= val_270 <= 15:
-                return val_270
-
-        # 策略 2: 相容性檢查
-        if len(packet) >= 278:
-            val_274 = struct.unpack_from("<I", packet, 274)[0]
-            if 0 <= val_274 <= 15:
-                return val_274
+# 封包 payload 起始位置 (Header 4 bytes + Type 1 byte + Counter 1 byte)
+BASE_INDEX = 6
 
+# 設備地址 (UINT32 LE) 固定位於 offset 270
+_ADDR_OFFSET = 270
+_ADDR_STRUCT = struct.Struct("<I")
+
+# Modbus 0x10 指令：[0] 從機 ID, [2:4] 寄存器 (BE), [7:9] 數值 (BE)
+_CMD_STRUCT = struct.Struct(">BxH3xH")
+
+# 逐欄位解碼用的 Struct 快取 (依資料型別)
+_FIELD_STRUCTS: Dict[str, struct.Struct] = {}
+
+def _field_struct(dtype: str) -> struct.Struct:
+    s = _FIELD_STRUCTS.get(dtype)
+    if s is None:
+        s = _FIELD_STRUCTS[dtype] = struct.Struct(f"<{dtype}")
+    return s
+
+# 🟢 [優化] 每個 packet_type 預先產生的專用解碼函式 (0x01 / 0x02)
+DECODERS: Dict[int, Callable[[bytes], Dict[str, Any]]] = {}
+
+def extract_device_address(packet: bytes) -> Optional[int]:
+    # 設備地址位於 offset 270 (BASE_INDEX 6 + BMS_MAP 0x01 的 264)
+    if len(packet) < _ADDR_OFFSET + 4:
         return None
-    except Exception as e:
-        logger.debug(f"提取設備地址失敗: {e}")
-        return None
+
+    val = _ADDR_STRUCT.unpack_from(packet, _ADDR_OFFSET)[0]
+    # 🟢 [優化] 防禦 RS485 雜訊：限制 ID 在 0~15 的合理範圍
+    if 0 <= val <= 15:
+        return val
+    return None
+
+def parse_01(packet: bytes) -> Tuple[Optional[int], Dict[str, Any]]:
+    """
+    一次取得 0x01 封包的 (硬體 ID, 設定值)。
+    硬體 ID 無效時直接回傳 (None, {})，不做整包解碼。
+    """
+    hw_id = extract_device_address(packet)
+    if hw_id is None:
+        return None, {}
+    return hw_id, decode_packet_01(packet)
 
 def decode_packet(packet: bytes, p_type: int) -> Dict[str, Any]:
     # 處理 Modbus 指令 (0x10)
     if p_type == 0x10 or p_type == 16:
         try:
-            target_sid = packet[0]
-            reg_addr = f"0x{packet[2:4].hex().upper()}"
-            val_hex = f"0x{packet[7:9].hex().upper()}"
-            val_int = struct.unpack(">H", packet[7:9])[0]
+            target_sid, reg, val_int = _CMD_STRUCT.unpack_from(packet, 0)
 
             return {
                 "msg_type": "master_cmd",
                 "target_slave_id": target_sid,
-                "register": reg_addr,
-                "value_hex": val_hex,
+                "register": f"0x{reg:04X}",
+                "value_hex": f"0x{val_int:04X}",
                 "value_int": val_int,
                 "description": f"Master 控制從機 {target_sid}"
             }
         except Exception as e:
-            logger.error(f"Modbus 0x10 解析失敗: {e}")
+            logger.error("Modbus 0x10 解析失敗: %s", e)
             return {}
 
+    decoder = DECODERS.get(p_type)
+    if decoder is not None:
+        return decoder(packet)
+
     if p_type not in BMS_MAP:
         return {}
 
+    return _decode_generic(packet, p_type)
+
+def _decode_generic(packet: bytes, p_type: int) -> Dict[str, Any]:
+    """逐欄位解碼 (封包長度不足時的後備路徑)"""
     res = {}
     register_def = BMS_MAP[p_type]
-    base_index = 6
 
     for off, entry in register_def.items():
         dtype = entry[2]
@@ -60,12 +87,72 @@ def decode_packet(packet: bytes, p_type: int) -> Dict[str, Any]:
         # 🟢 [優化] 防禦字典空字串：如果 entry[6] 存在且不為空字串，否則用預設值
         key_en = entry[6] if (len(entry) > 6 and entry[6]) else f"reg_{p_type}_{off}"
 
-        abs_off = base_index + off
-        if abs_off + struct.calcsize(f"<{dtype}") <= len(packet):
+        field_struct = _field_struct(dtype)
+        abs_off = BASE_INDEX + off
+        if abs_off + field_struct.size <= len(packet):
             try:
-                raw = struct.unpack_from(f"<{dtype}", packet, abs_off)[0]
+                raw = field_struct.unpack_from(packet, abs_off)[0]
                 res[key_en] = conv(raw) if conv else raw
             except Exception:
                 continue
 
     return res
+
+def _build_decoder(p_type: int, register_def: Dict[int, tuple]) -> Optional[Callable[[bytes], Dict[str, Any]]]:
+    """
+    將 BMS_MAP 編譯成單一 struct.Struct + 直線式 (straight-line) 解碼函式，
+    省去逐欄位的字典迭代與格式字串解析。
+    """
+    # 依 offset 排序組出一個帶填充 (x) 的格式字串
+    fmt = "<"
+    pos = 0
+    index_of = {}
+    for off in sorted(register_def):
+        dtype = register_def[off][2]
+        if off < pos:
+            # 欄位重疊，無法以單一 Struct 表示，改走逐欄位解碼
+            return None
+        if off > pos:
+            fmt += f"{off - pos}x"
+        fmt += dtype
+        index_of[off] = len(index_of)
+        pos = off + _field_struct(dtype).size
+
+    packer = struct.Struct(fmt)
+    min_len = BASE_INDEX + packer.size
+
+    convs = []
+    items = []
+    for off, entry in register_def.items():
+        conv = entry[3] if len(entry) > 3 else None
+        key_en = entry[6] if (len(entry) > 6 and entry[6]) else f"reg_{p_type}_{off}"
+        i = index_of[off]
+        if conv is None or conv is conv_none:
+            items.append(f"{key_en!r}: v[{i}]")
+        else:
+            items.append(f"{key_en!r}: _c[{len(convs)}](v[{i}])")
+            convs.append(conv)
+
+    name = f"_decode_0x{p_type:02X}"
+    src = (
+        f"def {name}(pkt, _s=_s, _c=_c, _g=_g, _n={min_len}, _b={BASE_INDEX}, _t={p_type}):\n"
+        f"    if len(pkt) < _n:\n"
+        f"        return _g(pkt, _t)\n"
+        f"    v = _s.unpack_from(pkt, _b)\n"
+        f"    return {{{', '.join(items)}}}\n"
+    )
+    namespace = {"_s": packer, "_c": tuple(convs), "_g": _decode_generic}
+    exec(compile(src, f"<jk_bms_{name}>", "exec"), namespace)
+    return namespace[name]
+
+for _p_type, _register_def in BMS_MAP.items():
+    # 0x10 Master 指令有獨立的解析格式，不走 BMS_MAP
+    if _p_type == 0x10:
+        continue
+    _decoder = _build_decoder(_p_type, _register_def)
+    if _decoder is not None:
+        DECODERS[_p_type] = _decoder
+
+# 🟢 [優化] 0x01 / 0x02 直接呼叫的解碼函式，熱路徑免去 decode_packet 的 p_type 分派
+decode_packet_01 = DECODERS.get(0x01) or (lambda packet: _decode_generic(packet, 0x01))
+decode_packet_02 = DECODERS.get(0x02) or (lambda packet: _decode_generic(packet, 0x02))
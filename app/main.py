@@ -3,34 +3,52 @@
 import time
 import os
 import sys
-import queue
+import collections
 import threading
 import logging
-import yaml
 import json
 import struct
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, List, Optional, Tuple
 
+from config_loader import CONFIG_PATH
 from transport import create_transport
-from decoder import decode_packet, extract_device_address
+from decoder import decode_packet_02, parse_01
 from publisher import get_publisher
 
-PACKET_QUEUE = queue.Queue(maxsize=500)
+# 🟢 [優化] 單一 producer (transport) / 單一 consumer (worker)：
+# deque 的 append/popleft 在 CPython 下為原子操作，只用一個 Event 喚醒 worker
+# (容量可由 queue_maxsize 選項調整，main() 啟動 worker 前依設定重建)
+DEFAULT_QUEUE_MAXSIZE = 500
+PACKET_QUEUE = collections.deque(maxlen=DEFAULT_QUEUE_MAXSIZE)
+PACKET_EVENT = threading.Event()
+QUEUE_DROP_LOG_EVERY = 100  # 隊列溢出時每丟棄 N 筆才記錄一次，避免 Log 洪水
+
+# 🟢 [優化] GIL 切換間隔 (預設 5ms)：拉長到 50ms，讓 transport 一次推完整批封包、worker 一次處理完
+GIL_SWITCH_INTERVAL = 0.05
+# 🟢 [優化] producer (讀取 UART/TCP) 的 nice 值；調高優先權需要 CAP_SYS_NICE，權限不足時維持預設
+PRODUCER_NICE = -5
 OPTIONS_PATH = "/data/options.json"
-CONFIG_PATH = "/data/config.yaml"
 
 # 🟢 [新增] 單機心跳監控全域變數
-DEVICE_STATUS_MAP = {}  # 格式: { device_id: {"last_seen": float, "state": "online"|"offline"} }
+DEVICE_STATUS_MAP = {}  # 格式: { device_id: {"last_seen": int (time.monotonic_ns), "state": "online"|"offline"} }
 DEVICE_TIMEOUT = 60.0   # 設備超過 60 秒無數據判定為離線
+DEVICE_TIMEOUT_NS = int(DEVICE_TIMEOUT * 1_000_000_000)
+
+# 🟢 [優化] 封包時間戳統一使用 time.monotonic_ns() 整數，比較時不需浮點運算
+NS_PER_SEC = 1_000_000_000
+MASTER_RESPONSE_WINDOW_NS = 1_500_000_000  # 點名後 1.5 秒內的回應歸屬給被點名的從機
 DEVICE_LOCK = threading.Lock() #  全域鎖
 
 def load_ui_config():
-    if not os.path.exists(OPTIONS_PATH):
+    try:
+        with open(OPTIONS_PATH, 'r', encoding='utf-8') as f:
+            options = json.load(f)
+    except FileNotFoundError:
         logging.error("❌ 找不到 HA options.json")
         sys.exit(1)
 
-    with open(OPTIONS_PATH, 'r', encoding='utf-8') as f:
-        options = json.load(f)
-
     ui_mode = options.get("connection_mode", "RS485 USB Dongle")
 
     config = {
@@ -39,7 +57,8 @@ def load_ui_config():
             "use_rs485_usb": ui_mode == "RS485 USB Dongle",
             "debug_raw_log": options.get("debug_raw_log", False),
             "packet_expire_time": options.get("packet_expire_time", 2.0),
-            "settings_publish_interval": options.get("settings_publish_interval", 60)
+            "settings_publish_interval": options.get("settings_publish_interval", 60),
+            "queue_maxsize": options.get("queue_maxsize", DEFAULT_QUEUE_MAXSIZE)
         },
         "tcp": {
             "host": options.get("modbus_host"),
@@ -59,152 +78,270 @@ def load_ui_config():
             "password": options.get("mqtt_password"),
             "discovery_prefix": options.get("mqtt_discovery_prefix", "homeassistant"),
             "topic_prefix": options.get("mqtt_topic_prefix", "Jikong_BMS"),
-            "client_id": options.get("mqtt_client_id", "jk_bms_monitor")
+            "client_id": options.get("mqtt_client_id", "jk_bms_monitor"),
+            "publish_batch_size": options.get("mqtt_publish_batch_size", 32)
         }
     }
 
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        yaml.dump(config, f)
-    return config
+    # 🟢 [優化] 設定直接以記憶體傳遞給 publisher / transport，不再回寫 config.yaml
+    return MappingProxyType(config)
+
+
+# 僅在 debug 模式下輸出一份實際生效的設定，方便除錯
+# 需在 logging.basicConfig 之後呼叫，否則失敗時的 warning 會先以預設等級初始化 root logger
+def _dump_effective_config(config):
+    try:
+        import yaml
+        with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(config, f, allow_unicode=True, default_flow_style=False)
+    except (ImportError, OSError) as e:
+        logging.getLogger("main").warning("⚠️ 無法輸出除錯用 config.yaml: %s", e)
+
+
+# 🟢 [優化] CPU 綁定：producer (main) 與 worker 分別固定在不同核心，減少快取互相干擾
+# 假設至少有 2 個可用核心；單核心或非 Linux 平台直接略過
+def _pin_current_thread(slot: int):
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < 2:
+            return
+        # pid 0 = 目前執行緒
+        os.sched_setaffinity(0, {cpus[slot % len(cpus)]})
+    except OSError as e:
+        logging.getLogger("main").debug("CPU 綁定失敗: %s", e)
+
+
+# Linux 的 nice() 只作用於呼叫它的執行緒，因此需在 worker 啟動後、於 producer 執行緒中呼叫
+def _raise_current_thread_priority(increment: int):
+    if not hasattr(os, "nice"):
+        return
+    try:
+        os.nice(increment)
+    except OSError as e:
+        # 容器未授予 CAP_SYS_NICE 時會失敗 (EPERM)，不影響功能
+        logging.getLogger("main").debug("調整優先權失敗: %s", e)
 
 
 # [新增] 獨立看門狗執行緒
-def device_watchdog_worker():
+def device_watchdog_worker(publisher):
     logger = logging.getLogger("watchdog")
-    publisher = get_publisher(CONFIG_PATH)
 
     while True:
-        now = time.time()
+        now = time.monotonic_ns()
 
         # 🟢 取出快照時上鎖
         with DEVICE_LOCK:
             devices_snapshot = list(DEVICE_STATUS_MAP.items())
 
         for dev_id, info in devices_snapshot:
-            if info["state"] == "online" and (now - info["last_seen"]) > DEVICE_TIMEOUT:
+            if info["state"] == "online" and (now - info["last_seen"]) > DEVICE_TIMEOUT_NS:
                 # 🟢 狀態變更時上鎖
                 with DEVICE_LOCK:
                     DEVICE_STATUS_MAP[dev_id]["state"] = "offline"
                 publisher.publish_device_status(dev_id, "offline")
-                logger.warning(f"⚠️ 設備掉線: BMS {dev_id} 已超過 {DEVICE_TIMEOUT} 秒未回應")
+                logger.warning("⚠️ 設備掉線: BMS %s 已超過 %s 秒未回應", dev_id, DEVICE_TIMEOUT)
         time.sleep(5)
 
 
-def process_packets_worker(app_config):
-    publisher = get_publisher(CONFIG_PATH)
-    packet_expire_time = app_config.get('packet_expire_time', 2.0)
+@dataclass(slots=True)
+class WorkerState:
+    """worker 執行緒的配對狀態 (僅由 worker 本身存取，不需上鎖)"""
+    publisher: Any
+    packet_expire_ns: int = 2 * NS_PER_SEC
+    # debug 狀態，用於控制是否顯示對話 Log
+    is_debug: bool = False
+    logger: logging.Logger = field(default_factory=lambda: logging.getLogger("worker"))
+
+    last_polled_slave_id: Optional[int] = None
+    last_poll_timestamp: int = 0
+    # 最近一筆尚未配對的 0x02 即時數據 (時間戳 + 原始封包)
+    pending_rt_time: int = 0
+    pending_rt_data: Optional[bytes] = None
+
+    # 🟢 [優化] 待發布的 (device_id, packet_type, payload) 先暫存，批次送出
+    outbox: List[Tuple[int, int, Dict[str, Any]]] = field(default_factory=list)
+    publish_batch_size: int = 32
+
+    @classmethod
+    def from_config(cls, publisher, app_config, publish_batch_size=32) -> "WorkerState":
+        return cls(
+            publisher=publisher,
+            packet_expire_ns=int(float(app_config.get('packet_expire_time', 2.0)) * NS_PER_SEC),
+            is_debug=bool(app_config.get("debug_raw_log", False)),
+            publish_batch_size=max(1, int(publish_batch_size)),
+        )
+
+
+# 1. 監聽到 Master 指令 (0x10)
+def _on_master_cmd(state, timestamp, packet_data):
+    # 🟢 [優化] 0x10 只用於歸屬判定，直接讀 Byte 0 (從機 ID)，不再完整解碼成 dict
+    # (transport 已驗證封包結構，長度固定 11 bytes)
+    if not packet_data:
+        return
+    target_id = packet_data[0]
+
+    # 🟢 除錯顯示：誰在問？
+    if state.is_debug:
+        state.logger.debug(" [詢問] Master 正在呼叫從機 ID: %s", target_id)
+
+    state.last_polled_slave_id = target_id
+    state.last_poll_timestamp = timestamp
+
+
+# 2. 暫存 0x02
+def _on_realtime(state, timestamp, packet_data):
+    state.pending_rt_time = timestamp
+    state.pending_rt_data = packet_data
+
+
+# 3. 處理回應 (0x01) - 這裡是資料處理核心
+def _on_settings(state, timestamp, packet_data):
+    logger = state.logger
+    is_debug = state.is_debug
+    publisher = state.publisher
+
+    # 🟢 [優化] 硬體 ID 與設定值一次解析完成
+    hw_id, settings_map = parse_01(packet_data)
+
+    # 🟢 除錯顯示：如果解析失敗，印出來警告
+    if hw_id is None:
+        if is_debug: logger.debug("[忽略] 無法從封包解析出硬體 ID (Offset 可能錯誤)")
+        return
+
+    target_publish_id = None
+    # 用於 Debug 顯示判定理由 (格式字串 + 參數，只有真的輸出 Log 時才組字串)
+    reason_fmt, reason_arg = "", None
+
+    # --- 歸屬判定邏輯 ---
+    if hw_id == 0:
+        target_publish_id = 0
+        reason_fmt, reason_arg = "硬體 ID 為 %s -> 絕對判定為 Master", hw_id
+    else:
+        time_diff = timestamp - state.last_poll_timestamp
+        if time_diff > MASTER_RESPONSE_WINDOW_NS:
+            target_publish_id = 0
+            reason_fmt, reason_arg = "回應超時 (%.1fs) -> 推定為 Master 自發廣播", time_diff / NS_PER_SEC
+        else:
+            target_publish_id = state.last_polled_slave_id
+            reason_fmt, reason_arg = "回應即時 -> 歸屬給剛才被點名的 ID: %s", state.last_polled_slave_id
+
+    # 🟢 除錯顯示：誰在答？以及程式判定給誰？
+    if is_debug:
+        logger.debug(" [回答] 解析硬體 ID: %s | 判定歸屬: %s | 理由: " + reason_fmt,
+                     hw_id, target_publish_id, reason_arg)
+
+    if target_publish_id is not None:
+
+        # 🟢 更新時間與狀態時上鎖
+        # (直接沿用封包進入隊列時的單調時鐘時間戳，不再另外讀取時鐘)
+        with DEVICE_LOCK:
+            dev_info = DEVICE_STATUS_MAP.setdefault(target_publish_id, {"last_seen": 0, "state": "offline"})
+            dev_info["last_seen"] = timestamp
+            current_state = dev_info["state"]
+            if current_state == "offline":
+                dev_info["state"] = "online"
+
+        # (把 MQTT 發布移出鎖的範圍，避免網路延遲卡住其他封包處理)
+        if current_state == "offline":
+            publisher.publish_device_status(target_publish_id, "online")
+
+        # (A) 0x10 指令僅用於歸屬判定，publisher 本身也不發布 (隱藏邏輯)，不再排入發布
+
+        # (B) 發布 0x01
+        if settings_map:
+            state.outbox.append((target_publish_id, 0x01, settings_map))
+
+        # (C) 發布 0x02
+        if state.pending_rt_data is not None:
+            rt_time, rt_data = state.pending_rt_time, state.pending_rt_data
+            state.pending_rt_data = None
+            if (timestamp - rt_time) <= state.packet_expire_ns:
+                realtime_map = decode_packet_02(rt_data)
+                if realtime_map:
+                    state.outbox.append((target_publish_id, 0x02, realtime_map))
+                    # 🟢 確認發布
+                    if is_debug: logger.debug("✅ [發布] 成功發送 BMS %s 的即時數據至 MQTT", target_publish_id)
+
+
+def _flush_outbox(state):
+    outbox = state.outbox
+    if not outbox:
+        return
+    # 🟢 [優化] 同一批內同一設備/同類型的數據只保留最新一筆 (BMS 狀態值只需最新值)
+    # 批次本身受 publish_batch_size 與「隊列清空即送出」限制，不會額外增加延遲
+    if len(outbox) > 1:
+        latest = {}
+        for device_id, packet_type, payload in outbox:
+            latest[(device_id, packet_type)] = payload
+        if len(latest) < len(outbox):
+            outbox[:] = [(device_id, packet_type, payload)
+                         for (device_id, packet_type), payload in latest.items()]
+    try:
+        state.publisher.publish_batch(outbox)
+    finally:
+        # 發布失敗時整批丟棄 (例外由 worker 記錄)，避免同一批反覆重試且 outbox 無限增長
+        outbox.clear()
+
+
+def _noop(state, timestamp, packet_data):
+    pass
+
+
+# 🟢 [優化] packet_type -> 處理函式 分派表，取代 if 串接
+_HANDLERS = {
+    0x10: _on_master_cmd,
+    0x02: _on_realtime,
+    0x01: _on_settings,
+}
 
-    # 取得 debug 狀態，用於控制是否顯示對話 Log
-    is_debug = bool(app_config.get("debug_raw_log", False))
 
-    last_polled_slave_id = None
-    last_poll_timestamp = 0
-    pending_cmds = {}
-    pending_realtime_data = {}
+def process_packets_worker(app_config, publisher, mqtt_config=None):
+    _pin_current_thread(1)
+    batch_size = (mqtt_config or {}).get("publish_batch_size", 32)
+    state = WorkerState.from_config(publisher, app_config, batch_size)
+    logger = state.logger
 
-    logger = logging.getLogger("worker")
+    # 🟢 [優化] 熱路徑用到的全域/屬性先綁定為區域變數，迴圈內不再重複查找
+    queue = PACKET_QUEUE
+    popleft = queue.popleft
+    wait_event = PACKET_EVENT.wait
+    clear_event = PACKET_EVENT.clear
+    get_handler = _HANDLERS.get
+    noop = _noop
+    outbox = state.outbox
+    batch_limit = state.publish_batch_size
+    log_error = logger.error
 
     while True:
         try:
-            packet_item = PACKET_QUEUE.get()
-            timestamp, packet_type, packet_data = packet_item
-
-            try:
-                # 1. 監聽到 Master 指令 (0x10)
-                if packet_type == 0x10:
-                    cmd_map = decode_packet(packet_data, 0x10)
-                    if cmd_map:
-                        target_id = cmd_map.get("target_slave_id")
-
-                        # 🟢 除錯顯示：誰在問？
-                        if is_debug:
-                            logger.debug(f" [詢問] Master 正在呼叫從機 ID: {target_id}")
-
-                        last_polled_slave_id = target_id
-                        last_poll_timestamp = timestamp
-                        pending_cmds[target_id] = cmd_map
-                    continue
-
-                # 2. 暫存 0x02
-                if packet_type == 0x02:
-                    pending_realtime_data["last"] = (timestamp, packet_data)
-                    continue
-
-                # 3. 處理回應 (0x01) - 這裡是資料處理核心
-                if packet_type == 0x01:
-                    hw_id = extract_device_address(packet_data)
-
-                    # 🟢 除錯顯示：如果解析失敗，印出來警告
-                    if hw_id is None:
-                        if is_debug: logger.debug("[忽略] 無法從封包解析出硬體 ID (Offset 可能錯誤)")
-                        continue
-
-                    target_publish_id = None
-                    reason_msg = "" # 用於 Debug 顯示判定理由
-
-                    # --- 歸屬判定邏輯 ---
-                    if hw_id == 0:
-                        target_publish_id = 0
-                        reason_msg = "硬體 ID 為 0 -> 絕對判定為 Master"
-                    else:
-                        time_diff = timestamp - last_poll_timestamp
-                        if time_diff > 1.5:
-                            target_publish_id = 0
-                            reason_msg = f"回應超時 ({time_diff:.1f}s) -> 推定為 Master 自發廣播"
-                        else:
-                            target_publish_id = last_polled_slave_id
-                            reason_msg = f"回應即時 -> 歸屬給剛才被點名的 ID: {last_polled_slave_id}"
-
-                    # 🟢 除錯顯示：誰在答？以及程式判定給誰？
-                    if is_debug:
-                        logger.debug(f" [回答] 解析硬體 ID: {hw_id} | 判定歸屬: {target_publish_id} | 理由: {reason_msg}")
-
-                    if target_publish_id is not None:
-
-                        # 🟢 更新時間與狀態時上鎖
-                        now = time.time()
-                        with DEVICE_LOCK:
-                            dev_info = DEVICE_STATUS_MAP.setdefault(target_publish_id, {"last_seen": 0, "state": "offline"})
-                            dev_info["last_seen"] = now
-                            current_state = dev_info["state"]
-                            if current_state == "offline":
-                                dev_info["state"] = "online"
-
-                        # (把 MQTT 發布移出鎖的範圍，避免網路延遲卡住其他封包處理)
-                        if current_state == "offline":
-                            publisher.publish_device_status(target_publish_id, "online")
-
-                        # (A) 發布指令
-                        if target_publish_id in pending_cmds:
-                            publisher.publish_payload(0, 0x10, pending_cmds.pop(target_publish_id))
-
-                        # (B) 發布 0x01
-                        settings_map = decode_packet(packet_data, 0x01)
-                        if settings_map:
-                            publisher.publish_payload(target_publish_id, 0x01, settings_map)
-
-                        # (C) 發布 0x02
-                        if "last" in pending_realtime_data:
-                            rt_time, rt_data = pending_realtime_data.pop("last")
-                            if (timestamp - rt_time) <= packet_expire_time:
-                                realtime_map = decode_packet(rt_data, 0x02)
-                                if realtime_map:
-                                    publisher.publish_payload(target_publish_id, 0x02, realtime_map)
-                                    # 🟢 確認發布
-                                    if is_debug: logger.debug(f"✅ [發布] 成功發送 BMS {target_publish_id} 的即時數據至 MQTT")
-
-                    if (timestamp - last_poll_timestamp) > 5.0:
-                        pending_cmds.clear()
-
-            except Exception as e:
-                logger.error(f"解析錯誤: {e}")
-            finally:
-                PACKET_QUEUE.task_done()
-        except Exception as e:
-            logger.error(f"Worker 循環錯誤: {e}")
+            # 🟢 [優化] 一次喚醒取完所有已到達的封包，降低 producer/consumer 之間的 GIL 來回切換
+            # 只在隊列為空時才等待：上一輪若因例外中斷，剩餘封包不必等下一個新封包才處理
+            if not queue:
+                wait_event()
+            clear_event()
+
+            while queue:
+                timestamp, packet_type, packet_data = popleft()
+                try:
+                    get_handler(packet_type, noop)(state, timestamp, packet_data)
+                except (ValueError, struct.error, KeyError, IndexError, TypeError) as e:
+                    log_error("解析錯誤: %s", e)
+
+                if len(outbox) >= batch_limit:
+                    _flush_outbox(state)
+
+            # 隊列清空後一次送出本輪累積的 MQTT 訊息
+            _flush_outbox(state)
+        except Exception:
+            # 非預期錯誤 (程式錯誤) 需完整 traceback 才能追查；worker 為 daemon 執行緒，
+            # 沒有外部監督者可重啟，因此記錄後繼續運作
+            logger.exception("Worker 循環錯誤")
             time.sleep(1)
 
 def main():
+    global PACKET_QUEUE
     full_cfg = load_ui_config()
     app_cfg = full_cfg.get('app', {})
 
@@ -218,29 +355,49 @@ def main():
     logger.info("==========================================")
     logger.info(" JiKong RS485 PB2A16S30P BMS 監控系統 v2.1.2 (單機 LWT 支援 + Thread Safety)")
     logger.info("✅ 最終修正: 地址偏移量校準為 270 (BMS 0 回歸)")
-    logger.info(f" 介面: {'USB 直連' if app_cfg.get('use_rs485_usb') else 'TCP 網關'}")
+    logger.info(" 介面: %s", 'USB 直連' if app_cfg.get('use_rs485_usb') else 'TCP 網關')
     logger.info("==========================================")
 
-    _ = get_publisher(CONFIG_PATH)
+    if app_cfg.get("debug_raw_log"):
+        _dump_effective_config(dict(full_cfg))
 
-    worker = threading.Thread(target=process_packets_worker, args=(app_cfg,), daemon=True)
+    # 🟢 [優化] publisher 只在這裡建立一次，直接傳給 worker 與看門狗
+    publisher = get_publisher(full_cfg)
+
+    sys.setswitchinterval(GIL_SWITCH_INTERVAL)
+
+    PACKET_QUEUE = collections.deque(maxlen=max(1, int(app_cfg.get("queue_maxsize", DEFAULT_QUEUE_MAXSIZE))))
+
+    worker = threading.Thread(target=process_packets_worker, args=(app_cfg, publisher, full_cfg.get('mqtt', {})), daemon=True)
     worker.start()
 
     # 🟢 [新增] 啟動看門狗
-    watchdog = threading.Thread(target=device_watchdog_worker, daemon=True)
+    watchdog = threading.Thread(target=device_watchdog_worker, args=(publisher,), daemon=True)
     watchdog.start()
 
-    transport_inst = create_transport()
+    # worker 已自行綁定第 2 核心，producer (讀取串口/TCP) 固定在第 1 核心
+    _pin_current_thread(0)
+    _raise_current_thread_priority(PRODUCER_NICE)
+
+    transport_inst = create_transport(full_cfg)
     try:
+        queue_maxlen = PACKET_QUEUE.maxlen
+        dropped = 0
         for pkt_type, pkt_data in transport_inst.packets():
-            if not PACKET_QUEUE.full():
-                PACKET_QUEUE.put((time.time(), pkt_type, pkt_data))
-            else:
-                logger.warning("⚠️ 隊列已滿，請檢查系統效能")
+            # 🟢 [優化] 隊列滿時丟棄最舊的封包 (deque maxlen 於 append 時自動淘汰)，保留最新數據
+            is_full = len(PACKET_QUEUE) >= queue_maxlen
+            PACKET_QUEUE.append((time.monotonic_ns(), pkt_type, pkt_data))
+            if not PACKET_EVENT.is_set():
+                PACKET_EVENT.set()
+            if is_full:
+                dropped += 1
+                if dropped % QUEUE_DROP_LOG_EVERY == 1:
+                    logger.warning("⚠️ 隊列已滿 (容量 %d)，累計已丟棄 %d 筆最舊封包，請檢查系統效能",
+                                   queue_maxlen, dropped)
     except KeyboardInterrupt:
         logger.info(" 系統停止")
     except Exception as e:
-        logger.error(f"💥 傳輸層崩倉: {e}")
+        logger.error("💥 傳輸層崩倉: %s", e)
 
 if __name__ == "__main__":
     main()
@@ -1,26 +1,88 @@
 # publisher.py mqtt 發布 
 import json
+import socket
+import threading
 import time
-import yaml
-import os
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Mapping, Tuple, Union
 import paho.mqtt.client as mqtt
 from bms_registers import BMS_MAP
+from config_loader import CONFIG_PATH, load_config
+
+try:
+    # 🟢 [優化] orjson (Rust) 編碼比標準 json 快數倍，回傳 bytes 可直接交給 paho
+    from orjson import dumps as _json_dumps
+except ImportError:
+    _json_dumps = json.dumps
 
 logger = logging.getLogger("jk_bms_publisher")
 
+def _discovery_entries(packet_type: int, data_map: Dict[int, Any]) -> Tuple[Tuple[str, str, str, Dict[str, str]], ...]:
+    """
+    將寄存器表轉成 discovery 模板：(name_cn, ha_type, key_en, 與設備無關的欄位)。
+    """
+    entries = []
+    for offset, entry in data_map.items():
+        name_cn = entry[0]
+        unit = entry[1]
+        ha_type = entry[4] if len(entry) > 4 else "sensor"
+        # [修正 1] 抓取第 5 個位置的圖示設定
+        icon = entry[5] if len(entry) > 5 else None
+        key_en = entry[6] if len(entry) > 6 else f"reg_{packet_type}_{offset}"
+
+        fields = {
+#            "value_template": f"{{{{ value_json['{name_cn}'] }}}}"
+            # [修改] 改去讀 MQTT 裡的英文 Key
+            "value_template": f"{{{{ value_json['{key_en}'] }}}}"
+        }
+
+        # 🟢 [修正 2] 如果有定義圖示，就寫進 HA 的設定檔裡
+        if icon:
+            fields["icon"] = icon
+
+        # 定義 binary_sensor 的 ON/OFF 映射
+        if ha_type == "binary_sensor":
+            fields["payload_on"] = "1"
+            fields["payload_off"] = "0"
+
+        if unit and unit not in ("Hex", "Bit", "Enum"):
+            fields["unit_of_measurement"] = unit
+
+        entries.append((name_cn, ha_type, key_en, fields))
+    return tuple(entries)
+
+def _state_kind(packet_type: int) -> str:
+    return "realtime" if packet_type == 0x02 else "settings"
+
+def _device_label(device_id: Any) -> str:
+    """HA 裝置名稱中的編號 (BMS 0 即 Master)"""
+    return f"{device_id if device_id != 0 else '0 (Master)'}"
+
+# discovery 模板內代替 device_id 的佔位字串；裝置名稱另用一個，因 BMS 0 顯示為 "0 (Master)"
+_DEVICE_PLACEHOLDER = "__DEVICE__"
+_DEVICE_LABEL_PLACEHOLDER = "__DEVICE_LABEL__"
+_DEVICE_PLACEHOLDER_B = _DEVICE_PLACEHOLDER.encode()
+_DEVICE_LABEL_PLACEHOLDER_B = _DEVICE_LABEL_PLACEHOLDER.encode()
+
+# 🟢 [優化] BMS_MAP 為固定表：載入模組時就把每個 packet_type 的 discovery 模板整理好，
+# 每台設備第一次註冊時只需代入 device_id (0x10 指令包不註冊感測器)
+DISCOVERY_TEMPLATES: Dict[int, Tuple[Tuple[str, str, str, Dict[str, str]], ...]] = {
+    packet_type: _discovery_entries(packet_type, data_map)
+    for packet_type, data_map in BMS_MAP.items()
+    if packet_type != 0x10
+}
+
 class MqttPublisher:
     """
     v2.0.9 MQTT 發布器：支援單機 LWT 與雙重狀態矩陣
     """
 
-    def __init__(self, config_path: str = "/data/config.yaml"):
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"找不到設定檔: {config_path}")
-
-        with open(config_path, "r", encoding="utf-8") as f:
-            full_cfg = yaml.safe_load(f)
+    def __init__(self, config: Union[str, Mapping[str, Any]] = CONFIG_PATH):
+        if isinstance(config, Mapping):
+            # 🟢 [優化] 直接使用 main.py 傳入的設定，免去 YAML 檔案往返
+            full_cfg = config
+        else:
+            full_cfg = load_config(config)
 
         self.mqtt_cfg = full_cfg.get("mqtt", {})
         self.app_cfg = full_cfg.get("app", {})
@@ -29,6 +91,11 @@ class MqttPublisher:
         self.topic_prefix = self.mqtt_cfg.get("topic_prefix", "Jikong_BMS")
         self.client_id = self.mqtt_cfg.get("client_id", "jk_bms_monitor")
         self.status_topic = f"{self.topic_prefix}/status"
+        # 🟢 [優化] topic 模板只組一次，之後以 % 代入 device_id 等欄位 (prefix 內的 % 先跳脫)
+        topic_prefix = self.topic_prefix.replace("%", "%%")
+        self._state_topic_fmt = topic_prefix + "/%s/%s"
+        self._device_status_topic_fmt = topic_prefix + "/%s/status"
+        self._discovery_topic_fmt = self.discovery_prefix.replace("%", "%%") + "/%s/jk_bms_%s/%s/config"
 
         broker = self.mqtt_cfg.get("host", "core-mosquitto")
         port = int(self.mqtt_cfg.get("port", 1883))
@@ -44,16 +111,25 @@ class MqttPublisher:
         self.client.will_set(self.status_topic, payload="offline", qos=1, retain=True)
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_socket_open = self._on_socket_open
 
         try:
             self.client.connect_async(broker, port, keepalive=60)
             self.client.loop_start()
-            logger.info(f"📡 MQTT 啟動: {broker}:{port}")
+            logger.info("📡 MQTT 啟動: %s:%s", broker, port)
         except Exception as e:
-            logger.error(f"❌ MQTT 啟動失敗: {e}")
-
-        self.settings_last_publish: Dict[int, float] = {}
-        self._published_discovery = set()
+            logger.error("❌ MQTT 啟動失敗: %s", e)
+
+        # 🟢 [優化] 0x01 設定值：device_id -> (內容雜湊, 上次發布的 time.monotonic())；內容未變且未達間隔時不重複發布
+        self.settings_last_publish: Dict[int, Tuple[int, float]] = {}
+        self.settings_publish_interval = float(self.app_cfg.get("settings_publish_interval", 60))
+        # packet_type -> 已序列化、以佔位字串代替 device_id 的 discovery 訊息 [(topic, payload)] (所有設備共用)
+        self._placeholder_discovery: Dict[int, List[Tuple[str, bytes]]] = {}
+        # 🟢 [優化] device_id -> 已註冊 packet_type 的位元遮罩 (bit n = packet_type n)，發布時免去函式呼叫與 tuple 雜湊
+        self._discovery_mask: Dict[int, int] = {}
+        # 🟢 [優化] 預先組好的 topic 字串快取，避免每次發布都重新格式化
+        self._topics: Dict[Tuple[int, int], str] = {}
+        self._device_status_topics: Dict[int, str] = {}
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -61,120 +137,195 @@ class MqttPublisher:
             logger.info("✅ MQTT 已連線")
             client.publish(self.status_topic, payload="online", qos=1, retain=True)
         else:
-            logger.warning(f"⚠️ MQTT 連線錯誤 rc={rc}")
+            logger.warning("⚠️ MQTT 連線錯誤 rc=%s", rc)
 
     def _on_disconnect(self, client, userdata, rc):
         self._connected = False
 
-    def _safe_publish(self, topic: str, payload: str, retain: bool = False):
+    def _on_socket_open(self, client, userdata, sock):
+        # 🟢 [優化] 關閉 Nagle：小封包 MQTT 訊息立即送出，不等待 ACK 合併 (最多 ~40ms 延遲)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError) as e:
+            logger.debug("TCP_NODELAY 設定失敗: %s", e)
+
+    def _safe_publish(self, topic: str, payload: Union[str, bytes], retain: bool = False):
         try:
             self.client.publish(topic, payload=payload, retain=retain, qos=0)
             return True
         except Exception as e:
             # 依賴底層例外捕捉，不吞掉斷線時的其他錯誤
-            logger.debug(f"發布失敗 ({topic}): {e}")
+            logger.debug("發布失敗 (%s): %s", topic, e)
             return False
 
-    def _make_device_info(self, device_id: int) -> Dict[str, Any]:
+    def _publish_many(self, messages, retain: bool = False) -> int:
+        """
+        連續送出多筆 (topic, payload)，回傳成功筆數。
+        🟢 [優化] client.publish 只查找一次；訊息全部排入 paho 佇列後由網路執行緒一起寫出
+        """
+        publish = self.client.publish
+        sent = 0
+        for topic, payload in messages:
+            try:
+                publish(topic, payload=payload, retain=retain, qos=0)
+                sent += 1
+            except Exception as e:
+                logger.debug("發布失敗 (%s): %s", topic, e)
+        return sent
+
+    def _make_device_info(self, device_id: Any, device_label: Optional[str] = None) -> Dict[str, Any]:
         """
         更新設備製造商與型號資訊
         """
+        if device_label is None:
+            device_label = _device_label(device_id)
         return {
             "identifiers": [f"jk_bms_{device_id}"],
             "manufacturer": "JiKong (JK-BMS)",
             "model": "PB2A16S30P (RS485/Parallel)",
-            "name": f"JK BMS {device_id if device_id != 0 else '0 (Master)'}",
+            "name": f"JK BMS {device_label}",
         }
 
+    def _state_topic(self, device_id: int, packet_type: int) -> str:
+        """(device_id, packet_type) -> 數據 state topic (快取)"""
+        topic = self._topics.get((device_id, packet_type))
+        if topic is None:
+            topic = self._topics[(device_id, packet_type)] = self._state_topic_fmt % (device_id, _state_kind(packet_type))
+        return topic
+
+    def _device_status_topic(self, device_id: int) -> str:
+        """device_id -> 單機在線狀態 topic (快取)"""
+        topic = self._device_status_topics.get(device_id)
+        if topic is None:
+            topic = self._device_status_topics[device_id] = self._device_status_topic_fmt % device_id
+        return topic
+
     # 🟢 [新增] 單機狀態發布
     def publish_device_status(self, device_id: int, status: str):
         """發布單一電池的在線/離線狀態"""
-        topic = f"{self.topic_prefix}/{device_id}/status"
+        topic = self._device_status_topic(device_id)
         self._safe_publish(topic, payload=status, retain=True)
         if status == "online":
-            logger.info(f"🔄 設備上線: BMS {device_id}")
+            logger.info("🔄 設備上線: BMS %s", device_id)
+
+    def _render_discovery_messages(self, device_id: Any, device_label: str, packet_type: int,
+                                   entries) -> List[Tuple[str, bytes]]:
+        """依 discovery 模板組出某設備某封包類型的全部 (topic, payload bytes)"""
+        device_info = self._make_device_info(device_id, device_label)
+        state_topic = self._state_topic_fmt % (device_id, _state_kind(packet_type))
+        device_status_topic = self._device_status_topic_fmt % device_id
+        discovery_topic_fmt = self._discovery_topic_fmt
+        messages = []
+
+        # 🟢 [優化] 同一設備所有實體共用的欄位在迴圈外組好一次 (每筆序列化後即丟棄，可安全共用)
+        base_payload = {
+            "state_topic": state_topic,
+            "device": device_info,
+            # 🟢 [修改] 替換為雙重可用性矩陣 (閘道器存活 + 單機存活)
+            "availability": [
+                {"topic": self.status_topic},
+                {"topic": device_status_topic}
+            ],
+            "availability_mode": "all",
+            "payload_available": "online",
+            "payload_not_available": "offline",
+        }
+        id_prefix = f"jk_bms_{device_id}_"
+
+        # 每個實體只需代入 device_id 相關欄位，其餘欄位直接沿用模板
+        for name_cn, ha_type, key_en, extra_fields in entries:
+            base_id = id_prefix + key_en
+            payload = {"name": name_cn, "unique_id": base_id, "object_id": base_id,
+                       **base_payload, **extra_fields}
+
+            topic = discovery_topic_fmt % (ha_type, device_id, key_en)
+            encoded = _json_dumps(payload)
+            if isinstance(encoded, str):
+                encoded = encoded.encode("utf-8")
+            messages.append((topic, encoded))
+
+        return messages
+
+    def _build_discovery_messages(self, device_id: int, packet_type: int, data_map: Dict[int, Any]) -> List[Tuple[str, bytes]]:
+        """把某設備某封包類型的全部 HA discovery 訊息一次組好並序列化為 (topic, payload)"""
+        if data_map is not BMS_MAP.get(packet_type):
+            return self._render_discovery_messages(device_id, _device_label(device_id), packet_type,
+                                                   _discovery_entries(packet_type, data_map))
+
+        # 🟢 [優化] 每個 packet_type 只序列化一次 (device_id 以佔位字串代替)，
+        # 之後每台新設備只需 bytes.replace 代入 device_id，不再重新組 dict / 序列化
+        template = self._placeholder_discovery.get(packet_type)
+        if template is None:
+            template = self._placeholder_discovery[packet_type] = self._render_discovery_messages(
+                _DEVICE_PLACEHOLDER, _DEVICE_LABEL_PLACEHOLDER, packet_type, DISCOVERY_TEMPLATES[packet_type])
+
+        device_str = str(device_id)
+        device_bytes = device_str.encode()
+        label_bytes = _device_label(device_id).encode("utf-8")
+        # 設備名稱的佔位字串較長，需先替換
+        return [
+            (topic.replace(_DEVICE_PLACEHOLDER, device_str),
+             payload.replace(_DEVICE_LABEL_PLACEHOLDER_B, label_bytes).replace(_DEVICE_PLACEHOLDER_B, device_bytes))
+            for topic, payload in template
+        ]
 
     def publish_discovery_for_packet_type(self, device_id: int, packet_type: int, data_map: Dict[int, Any]):
         """註冊 HA 實體"""
-        key = (device_id, packet_type)
-        if key in self._published_discovery: return
+        mask = self._discovery_mask.get(device_id, 0)
+        if (mask >> packet_type) & 1: return
 
         # ⛔ 隱藏邏輯：如果是指令包 (0x10)，直接忽略，不註冊感測器
         if packet_type == 0x10:
             return
 
-        self._published_discovery.add(key)
-        device_info = self._make_device_info(device_id)
-        kind = "realtime" if packet_type == 0x02 else "settings"
-        state_topic = f"{self.topic_prefix}/{device_id}/{kind}"
-
-        for offset, entry in data_map.items():
-            name_cn = entry[0]
-            unit = entry[1]
-            ha_type = entry[4] if len(entry) > 4 else "sensor"
-            # [修正 1] 抓取第 5 個位置的圖示設定
-            icon = entry[5] if len(entry) > 5 else None
-            key_en = entry[6] if len(entry) > 6 else f"reg_{packet_type}_{offset}"
-
-            base_id = f"jk_bms_{device_id}_{key_en}"
-            payload = {
-                "name": name_cn,
-                "unique_id": base_id,
-                "object_id": base_id,
-                "state_topic": state_topic,
-                "device": device_info,
-                # 🟢 [修改] 替換為雙重可用性矩陣 (閘道器存活 + 單機存活)
-                "availability": [
-                    {"topic": self.status_topic},
-                    {"topic": f"{self.topic_prefix}/{device_id}/status"}
-                ],
-                "availability_mode": "all",
-                "payload_available": "online",
-                "payload_not_available": "offline",
-#                "value_template": f"{{{{ value_json['{name_cn}'] }}}}"
-		# [修改] 改去讀 MQTT 裡的英文 Key
-		"value_template": f"{{{{ value_json['{key_en}'] }}}}"
-            }
-
-            # 🟢 [修正 2] 如果有定義圖示，就寫進 HA 的設定檔裡
-            if icon:
-                payload["icon"] = icon
-
-			# 定義 binary_sensor 的 ON/OFF 映射
-            if ha_type == "binary_sensor":
-                payload["payload_on"] = "1"
-                payload["payload_off"] = "0"
-
-            if unit and unit not in ("Hex", "Bit", "Enum"):
-                payload["unit_of_measurement"] = unit
-
-            topic = f"{self.discovery_prefix}/{ha_type}/jk_bms_{device_id}/{key_en}/config"
-            self._safe_publish(topic, json.dumps(payload), retain=True)
-
-    def publish_payload(self, device_id: int, packet_type: int, payload_dict: Dict[str, Any]):
-        """發布數據至 MQTT"""
+        # 🟢 [優化] 每個設備/封包類型只組裝、序列化並送出一次 (retain)，送出後以遮罩記錄
+        messages = self._build_discovery_messages(device_id, packet_type, data_map)
+        self._discovery_mask[device_id] = mask | (1 << packet_type)
+        self._publish_many(messages, retain=True)
+
+    def publish_payload(self, device_id: int, packet_type: int, payload_dict: Dict[str, Any],
+                        now: Optional[float] = None):
+        """發布數據至 MQTT (now: time.monotonic() 時間，批次發布時由呼叫端統一提供)"""
 
         # ⛔ 隱藏邏輯：如果是指令包 (0x10)，直接忽略，不發布數據
         if packet_type == 0x10:
             return
 
         if packet_type == 0x01:
-            interval = float(self.app_cfg.get("settings_publish_interval", 60))
-            if time.time() - self.settings_last_publish.get(device_id, 0) < interval:
+            # 🟢 [優化] 節流改用單調時鐘，不受 NTP 校時跳動影響
+            if now is None:
+                now = time.monotonic()
+            # 設定值皆為數值/字串，可直接雜湊；內容一變動就立即發布
+            digest = hash(tuple(payload_dict.items()))
+            last = self.settings_last_publish.get(device_id)
+            if last is not None and last[0] == digest and now - last[1] < self.settings_publish_interval:
                 return
-            self.settings_last_publish[device_id] = time.time()
+            self.settings_last_publish[device_id] = (digest, now)
 
-        kind = "realtime" if packet_type == 0x02 else "settings"
-        state_topic = f"{self.topic_prefix}/{device_id}/{kind}"
+        state_topic = self._state_topic(device_id, packet_type)
 
-        self._safe_publish(state_topic, json.dumps(payload_dict), retain=False)
+        self._safe_publish(state_topic, _json_dumps(payload_dict), retain=False)
 
-        if packet_type in BMS_MAP:
+        if not (self._discovery_mask.get(device_id, 0) >> packet_type) & 1 and packet_type in BMS_MAP:
             self.publish_discovery_for_packet_type(device_id, packet_type, BMS_MAP[packet_type])
 
+    def publish_batch(self, items):
+        """
+        依序發布一批 (device_id, packet_type, payload_dict)。
+        worker 每輪清空隊列後呼叫一次，讓 paho 網路執行緒能在同一次喚醒中把封包一起寫出。
+        """
+        # 整批共用同一個時間點，不必每筆都讀取時鐘
+        now = time.monotonic()
+        for device_id, packet_type, payload_dict in items:
+            self.publish_payload(device_id, packet_type, payload_dict, now)
+
 _publisher_instance = None
-def get_publisher(config_path: str = "/data/config.yaml"):
+_publisher_lock = threading.Lock()
+def get_publisher(config: Union[str, Mapping[str, Any]] = CONFIG_PATH):
     global _publisher_instance
+    # 已建立時不需上鎖；首次建立時上鎖，避免多個執行緒同時各建一個 MQTT 連線
     if _publisher_instance is None:
-        _publisher_instance = MqttPublisher(config_path)
+        with _publisher_lock:
+            if _publisher_instance is None:
+                _publisher_instance = MqttPublisher(config)
     return _publisher_instance
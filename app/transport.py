@@ -1,11 +1,11 @@
 # app/transport.py 切jk bms 封包長度
 import socket
+import struct
 import time
-import os
-import yaml
 import logging
 from abc import ABC, abstractmethod
-from typing import Tuple, Generator, Optional
+from typing import Tuple, Generator, Optional, Mapping, Any
+from config_loader import CONFIG_PATH, load_config
 
 try:
     import serial
@@ -13,14 +13,27 @@ except ImportError:
     serial = None
 
 logger = logging.getLogger("jk_bms_transport")
-CONFIG_PATH = "/data/config.yaml"
 HEADER_JK = b"\x55\xAA\xEB\x90"
 
 # Master 指令監控清單
 MASTER_LIST = [bytes([i, 0x10]) for i in range(16)]
+# 🟢 [優化] 0x10 指令 Byte 4~6 (Register Count, Byte Count) 一次 C 層解出
+_MASTER_CMD_COUNTS = struct.Struct(">HB")
+
+def _take_packet(buffer: bytearray, start: int, length: int) -> bytes:
+    """
+    從 buffer 取出一個封包並刪除已處理的部分。
+    🟢 [優化] 透過 memoryview 只複製一次 (bytearray 切片 + bytes() 會複製兩次)；
+    view 必須先釋放，才能縮短 bytearray。
+    """
+    end = start + length
+    with memoryview(buffer) as view:
+        packet = bytes(view[start:end])
+    del buffer[:end]
+    return packet
 
 class BaseTransport(ABC):
-    def __init__(self, cfg: dict):
+    def __init__(self, cfg: Mapping[str, Any]):
         self.app_cfg = cfg.get("app", {})
         self.serial_cfg = cfg.get("serial", {})
         self.tcp_cfg = cfg.get("tcp", {})
@@ -35,17 +48,15 @@ class BaseTransport(ABC):
         if len(buffer) < idx + 11:
             return False
 
-        # Byte 4~5: Register Count
-        reg_count = (buffer[idx + 4] << 8) | buffer[idx + 5]
-        # Byte 6: Byte Count
-        byte_count = buffer[idx + 6]
+        # Byte 4~5: Register Count, Byte 6: Byte Count
+        reg_count, byte_count = _MASTER_CMD_COUNTS.unpack_from(buffer, idx + 4)
 
         # 合法條件：
         # 1. 讀取長度在合理範圍 (1~10 個 Register)
         # 2. 回傳 Byte 數必須是 Register 數量的 2 倍
         if not (1 <= reg_count <= 10):
             return False
-        if byte_count != reg_count * 2:
+        if byte_count != reg_count << 1:
             return False
 
         return True
@@ -64,8 +75,7 @@ class BaseTransport(ABC):
                 p_type = buffer[jk_idx + 4]
                 p_len = 308 if p_type == 0x02 else 300
                 if len(buffer) >= jk_idx + p_len:
-                    yield p_type, bytes(buffer[jk_idx : jk_idx + p_len])
-                    del buffer[:jk_idx + p_len]
+                    yield p_type, _take_packet(buffer, jk_idx, p_len)
                     continue
                 else: break
 
@@ -73,14 +83,13 @@ class BaseTransport(ABC):
                 if len(buffer) >= mb_idx + 11:
                     # 🟢 [硬化] Modbus 結構驗證，防止誤判
                     if self._is_valid_master_cmd(buffer, mb_idx):
-                        yield 0x10, bytes(buffer[mb_idx : mb_idx + 11])
-                        del buffer[:mb_idx + 11]
+                        yield 0x10, _take_packet(buffer, mb_idx, 11)
                     else:
                         # 假 Header，跳過 2 bytes 繼續搜尋 (保護周圍可能真實的 JK 數據)
                         if self.debug_raw_log:
                             logger.debug(
-                                f"[防禦] 偵測到假 Master Header "
-                                f"at idx {mb_idx}，跳過"
+                                "[防禦] 偵測到假 Master Header "
+                                "at idx %d，跳過", mb_idx
                             )
                         del buffer[:mb_idx + 2]
                     continue
@@ -91,8 +100,8 @@ class BaseTransport(ABC):
             else:
                 if len(buffer) > 1024:
                     logger.warning(
-                        f"⚠️ 偵測到 RS485 雜訊，"
-                        f"強制清空 Buffer ({len(buffer)} bytes)"
+                        "⚠️ 偵測到 RS485 雜訊，"
+                        "強制清空 Buffer (%d bytes)", len(buffer)
                     )
                     buffer.clear()
                 break
@@ -110,17 +119,18 @@ class Rs485Transport(BaseTransport):
                     time.sleep(10); continue
 
                 ser = serial.Serial(port=device, baudrate=baud, timeout=1.0)
-                logger.info(f"🔌 USB 連線成功: {device}")
+                logger.info("🔌 USB 連線成功: %s", device)
                 buffer = bytearray()
                 while True:
                     data = ser.read(1024)
                     if not data: continue
-                    if self.debug_raw_log:
-                        logger.debug(f"[RAW] {data.hex().upper()}")
+                    # 🟢 [優化] 同時確認 logger 等級，避免在 DEBUG 未開啟時仍轉換整段 HEX
+                    if self.debug_raw_log and logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("[RAW] %s", data.hex(" ").upper())
                     buffer.extend(data)
                     yield from self._extract_packets(buffer)
             except Exception as e:
-                logger.error(f"❌ USB 錯誤: {e}"); time.sleep(5)
+                logger.error("❌ USB 錯誤: %s", e); time.sleep(5)
             finally:
                 if ser: ser.close()
 
@@ -137,7 +147,7 @@ class TcpTransport(BaseTransport):
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sock.settimeout(10.0)
                 sock.connect((host, port))
-                logger.info(f"🌐 TCP 成功: {host}:{port}")
+                logger.info("🌐 TCP 成功: %s:%s", host, port)
                 buffer = bytearray()
                 while True:
                     data = sock.recv(4096)
@@ -145,15 +155,17 @@ class TcpTransport(BaseTransport):
                     buffer.extend(data)
                     yield from self._extract_packets(buffer)
             except Exception as e:
-                logger.error(f"❌ TCP 錯誤: {e}"); time.sleep(5)
+                logger.error("❌ TCP 錯誤: %s", e); time.sleep(5)
             finally:
                 if sock: sock.close()
 
-def create_transport() -> BaseTransport:
-    if not os.path.exists(CONFIG_PATH):
-        return Rs485Transport({"app": {}, "serial": {}})
-    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-        cfg = yaml.safe_load(f)
+def create_transport(cfg: Optional[Mapping[str, Any]] = None) -> BaseTransport:
+    # 🟢 [優化] 優先使用 main.py 傳入的設定，未傳入時才讀取 config.yaml
+    if cfg is None:
+        try:
+            cfg = load_config(CONFIG_PATH)
+        except FileNotFoundError:
+            return Rs485Transport({"app": {}, "serial": {}})
     if cfg.get("app", {}).get("use_rs485_usb"):
         return Rs485Transport(cfg)
     return TcpTransport(cfg)